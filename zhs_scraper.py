@@ -14,20 +14,38 @@ Run periodically in an infinite loop.
 """
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.lexbor import LexborHTMLParser
 import smtplib
 from email.mime.text import MIMEText
 import time
-import json
 import os
+import hashlib
 import argparse
 from datetime import datetime
+from typing import NamedTuple
 import logging
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
 load_dotenv()
 import os
 
+try:
+    import orjson
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    json_loads = orjson.loads
+except ImportError:  # Fallback auf die Standardbibliothek
+    import json
+
+    def json_dumps(obj):
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+    json_loads = json.loads
+
 # Konfiguration
 URL = "https://www.buchung.zhs-muenchen.de/angebote/aktueller_zeitraum_0/_Krafttraining_-_Studio.html"
 INTERVAL = 10*60  # alle 10 Minuten
@@ -42,6 +60,57 @@ EMAIL_TO = os.getenv("EMAIL_TO")
 
 ERROR_LOG_FILE = 'error_log.json'
 ERROR_INTERVAL_HOURS = 24
+TRENNLINIE = "-" * 40  # Trenner zwischen Kursen in der Benachrichtigung
+
+# Buchungsstatus anhand des Buttons in der Buchungsspalte: (Tag, Klasse) -> Status
+STATUS_ZUORDNUNG = {
+    ('span', 'bs_btn_abgelaufen'): 'abgelaufen',
+    ('input', 'bs_btn_warteliste'): 'Warteliste',
+    ('input', 'bs_btn_buchen'): 'buchen',
+}
+# Ein kombinierter Selektor -> eine Suche pro Zelle statt einer pro möglichem Button
+STATUS_SELEKTOR = ', '.join(f"{tag}.{klasse}" for tag, klasse in STATUS_ZUORDNUNG)
+
+# Brotli nur anbieten, wenn urllib3 es auch dekodieren kann
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+
+
+def make_session():
+    """
+    Erstellt eine HTTP-Session mit Retry und Connection-Pooling, damit die Verbindung
+    zwischen den Abfragen offen bleibt und nicht jedes Mal neu aufgebaut wird.
+    """
+    session = requests.Session()
+    retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return session
+
+
+SESSION = make_session()
+
+class Kurs(NamedTuple):
+    """
+    Eine Zeile der Kurstabelle. Als NamedTuple deutlich kompakter als ein Dictionary pro Kurs.
+    """
+    kurs_nr: str
+    details: str
+    tag: str
+    zeit: str
+    zeitraum: str
+    leitung: str
+    preis: str
+    status: str
+
 
 def setup_logger(debug=False):
     """
@@ -65,51 +134,87 @@ def setup_logger(debug=False):
         logger.addHandler(console_handler)
 
 
-def scrape_kurse():
+def ermittle_status(zelle):
+    """
+    Bestimmt den Buchungsstatus anhand des ersten Buttons in der Zelle.
+    """
+    button = zelle.css_first(STATUS_SELEKTOR)
+    if button is None:
+        return "unbekannt"
+    for klasse in (button.attributes.get('class') or '').split():
+        status = STATUS_ZUORDNUNG.get((button.tag, klasse))
+        if status:
+            return status
+    return "unbekannt"
+
+
+def scrape_kurse(zustand):
     """
     Lädt und parst die Kursliste von der ZHS-Webseite.
 
     Extrahiert: kurs_nr, details, tag, zeit, zeitraum, leitung, preis, status
 
-    Rückgabewert: Liste von Kurs-Dictionaries oder None bei Fehler.
+    Sendet die gespeicherten ETag/Last-Modified-Werte mit. Antwortet der Server mit
+    304 Not Modified oder ist der Seiteninhalt (blake2b-Hash) unverändert, werden die
+    Kurse aus dem Zustand wiederverwendet, ohne die Seite erneut zu parsen. Neue Werte
+    werden in zustand['http_cache'] und zustand['page_digest'] abgelegt.
+
+    Rückgabewert: Liste von Kurs-Objekten oder None bei Fehler.
     """
     try:
-        response = requests.get(URL, timeout=10)
+        cache = zustand.get('http_cache', {})
+        headers = {}
+        if zustand.get('kurse'):
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+
+        response = SESSION.get(URL, headers=headers, timeout=10)
+        if response.status_code == 304:
+            logging.debug("Seite unverändert (304), verwende gespeicherte Kurse.")
+            return zustand['kurse']
         response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        table = soup.select_one('table.bs_kurse')  # Haupt-Tabelle mit Kursen finden
+        http_cache = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+
+        digest = hashlib.blake2b(response.content, digest_size=16).hexdigest()
+        if zustand.get('kurse') and digest == zustand.get('page_digest'):
+            logging.debug("Seiteninhalt unverändert, verwende gespeicherte Kurse.")
+            zustand['http_cache'] = http_cache
+            return zustand['kurse']
+
+        tree = LexborHTMLParser(response.content)
+        table = tree.css_first('table.bs_kurse')  # Haupt-Tabelle mit Kursen finden
         if not table:
             sende_error_email("Tabelle nicht gefunden", "Die Kurs-Tabelle konnte nicht auf der Seite gefunden werden.")
             return None
 
         kurse = []
-        for row in table.select('tbody tr'):
-            cols = row.find_all('td')
-            # Inhalte der Spalten extrahieren
-            kurs_info = {
-                "kurs_nr": cols[0].get_text(strip=True),
-                "details": cols[1].get_text(strip=True),
-                "tag": cols[2].get_text(strip=True),
-                "zeit": cols[3].get_text(strip=True),
-                "zeitraum": cols[5].get_text(strip=True),
-                "leitung": cols[6].get_text(strip=True),
-                "preis": cols[7].get_text(strip=True),
-            }
-
+        for row in table.css('tbody tr'):
+            cols = row.css('td')
             # Status anhand des HTML-Aufbaus bestimmen
-            buchung = cols[8]
-            if buchung.find('span', class_='bs_btn_abgelaufen'):
-                kurs_info["status"] = "abgelaufen"
-            elif buchung.find('input', class_='bs_btn_warteliste'):
-                kurs_info["status"] = "Warteliste"
-            elif buchung.find('input', class_='bs_btn_buchen'):
-                kurs_info["status"] = "buchen"
-            else:
-                kurs_info["status"] = "unbekannt"
+            kurs_status = ermittle_status(cols[8])
+
+            # Inhalte der Spalten extrahieren
+            kurs_info = Kurs(
+                kurs_nr=cols[0].text(strip=True),
+                details=cols[1].text(strip=True),
+                tag=cols[2].text(strip=True),
+                zeit=cols[3].text(strip=True),
+                zeitraum=cols[5].text(strip=True),
+                leitung=cols[6].text(strip=True),
+                preis=cols[7].text(strip=True),
+                status=kurs_status,
+            )
 
             logging.debug(f"Kurs gescraped: {kurs_info}")
             kurse.append(kurs_info)
 
+        zustand['http_cache'] = http_cache
+        zustand['page_digest'] = digest
         return kurse
     except Exception as e:
         logging.exception(f"Fehler beim Scrapen: {e}")
@@ -122,20 +227,40 @@ def lade_zustand():
     Gibt {} zurück, wenn keine Datei vorhanden ist.
     """
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            zustand = json.load(f)
+        with open(STATE_FILE, 'rb') as f:
+            zustand = json_loads(f.read())
+            zustand['kurse'] = [Kurs(**k) for k in zustand.get('kurse', [])]
             logging.debug("Zustand geladen.")
             return zustand
     logging.debug("Keine vorherige Zustandsdatei gefunden.")
     return {}
 
 
+def schreibe_atomar(pfad, daten):
+    """
+    Schreibt Bytes zuerst in eine temporäre Datei und ersetzt dann das Ziel per os.replace,
+    damit ein Absturz während des Schreibens keine halbe JSON-Datei hinterlässt.
+    """
+    tmp_pfad = pfad + ".tmp"
+    with open(tmp_pfad, 'wb') as f:
+        f.write(daten)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(tmp_pfad, pfad)
+    except OSError:
+        # z.B. Docker-Bind-Mount einer Einzeldatei: Umbenennen nicht möglich, direkt schreiben
+        with open(pfad, 'wb') as f:
+            f.write(daten)
+        os.remove(tmp_pfad)
+
+
 def speichere_zustand(zustand):
     """
     Speichert den aktuellen Kurszustand in die JSON-Datei.
     """
-    with open(STATE_FILE, 'w') as f:
-        json.dump(zustand, f, indent=2)
+    daten = dict(zustand, kurse=[k._asdict() for k in zustand.get('kurse', [])])
+    schreibe_atomar(STATE_FILE, json_dumps(daten))
     logging.debug("Zustand gespeichert.")
 
 
@@ -149,23 +274,23 @@ def vergleiche_kurse(alt, neu):
     - gelöschte Kurse (immer)
     """
     aenderungen = []
-    alter_kurse = {kurs['kurs_nr']: kurs for kurs in alt}
-    neue_kurse = {kurs['kurs_nr']: kurs for kurs in neu}
+    alter_kurse = {kurs.kurs_nr: kurs for kurs in alt}
+    neue_kurse = {kurs.kurs_nr: kurs for kurs in neu}
 
-    # Neue Kurse erkennen
+    # Neue Kurse und Statusänderungen in Seitenreihenfolge erkennen
     for kurs_nr, kurs in neue_kurse.items():
         if kurs_nr not in alter_kurse:
-            if kurs['status'] in ('buchen', 'Warteliste'):
+            if kurs.status in ('buchen', 'Warteliste'):
                 aenderungen.append({
                     "typ": "neu",
                     "kurs_nr": kurs_nr,
-                    "neuer_status": kurs['status'],
+                    "neuer_status": kurs.status,
                     "details": kurs
                 })
         else:
             # Statusänderung erkennen, nur wenn neu buchbar
-            alt_status = alter_kurse[kurs_nr]['status']
-            neu_status = kurs['status']
+            alt_status = alter_kurse[kurs_nr].status
+            neu_status = kurs.status
             if alt_status != neu_status:
                 if neu_status in ('buchen', 'Warteliste') and alt_status not in ('buchen', 'Warteliste'):
                     aenderungen.append({
@@ -182,7 +307,7 @@ def vergleiche_kurse(alt, neu):
             aenderungen.append({
                 "typ": "geloescht",
                 "kurs_nr": kurs_nr,
-                "alter_status": kurs['status'],
+                "alter_status": kurs.status,
                 "neuer_status": "entfernt",
                 "details": kurs
             })
@@ -190,6 +315,59 @@ def vergleiche_kurse(alt, neu):
     return aenderungen
 
 
+_SMTP = None  # offene SMTP-Verbindung, wird zwischen den Mails wiederverwendet
+
+
+def schliesse_smtp():
+    """
+    Schließt die gemerkte SMTP-Verbindung, falls vorhanden.
+    """
+    global _SMTP
+    if _SMTP is not None:
+        try:
+            _SMTP.quit()
+        except Exception:
+            _SMTP.close()
+        _SMTP = None
+
+
+def hole_smtp():
+    """
+    Gibt eine eingeloggte SMTP-Verbindung zurück. Eine bestehende Verbindung wird per NOOP
+    geprüft und nur bei Bedarf neu aufgebaut (connect, STARTTLS, Login).
+    """
+    global _SMTP
+    if _SMTP is not None:
+        try:
+            if _SMTP.noop()[0] == 250:
+                return _SMTP
+        except (smtplib.SMTPException, OSError):
+            pass
+        schliesse_smtp()
+
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        server.starttls()
+        server.login(SMTP_USER, SMTP_PASSWORD)
+    except Exception:
+        server.close()  # Socket nicht offen lassen, wenn STARTTLS oder Login scheitert
+        raise
+    _SMTP = server
+    return server
+
+
+def verschicke(msg):
+    """
+    Verschickt eine Mail über die gemeinsame SMTP-Verbindung, mit einem Neuversuch,
+    falls der Server die Verbindung zwischenzeitlich getrennt hat.
+    """
+    try:
+        hole_smtp().sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+    except smtplib.SMTPServerDisconnected:
+        schliesse_smtp()
+        hole_smtp().sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+
+
 def sende_email(aenderungen):
     """
     Sendet eine Email mit den Änderungen.
@@ -208,52 +386,53 @@ def sende_email(aenderungen):
     geloescht = [a for a in aenderungen if a["typ"] == "geloescht"]
     updates = [a for a in aenderungen if a["typ"] == "status_update"]
 
-    nachricht = ""
+    teile = []
     if neue:
-        nachricht += "🟢 Neue buchbare Kurse:\n\n"
+        teile.append("🟢 Neue buchbare Kurse:\n\n")
         for a in neue:
-            nachricht += (
+            teile.append(
                 f"Kursnummer: {a['kurs_nr']}\n"
                 f"Status: {a['neuer_status']}\n"
-                f"Tag: {a['details']['tag']}\n"
-                f"Zeit: {a['details']['zeit']}\n"
-                f"Zeitraum: {a['details']['zeitraum']}\n"
-                f"Leitung: {a['details']['leitung']}\n"
-                f"Preis: {a['details']['preis']}\n"
-                f"{'-'*40}\n"
+                f"Tag: {a['details'].tag}\n"
+                f"Zeit: {a['details'].zeit}\n"
+                f"Zeitraum: {a['details'].zeitraum}\n"
+                f"Leitung: {a['details'].leitung}\n"
+                f"Preis: {a['details'].preis}\n"
+                f"{TRENNLINIE}\n"
             )
-        nachricht += "\n"
+        teile.append("\n")
 
     if updates:
-        nachricht += "🔁 Verfügbarkeitsänderungen:\n\n"
+        teile.append("🔁 Verfügbarkeitsänderungen:\n\n")
         for a in updates:
-            nachricht += (
+            teile.append(
                 f"Kursnummer: {a['kurs_nr']}\n"
                 f"Status: {a['alter_status']} → {a['neuer_status']}\n"
-                f"Tag: {a['details']['tag']}\n"
-                f"Zeit: {a['details']['zeit']}\n"
-                f"Zeitraum: {a['details']['zeitraum']}\n"
-                f"Leitung: {a['details']['leitung']}\n"
-                f"Preis: {a['details']['preis']}\n"
-                f"{'-'*40}\n"
+                f"Tag: {a['details'].tag}\n"
+                f"Zeit: {a['details'].zeit}\n"
+                f"Zeitraum: {a['details'].zeitraum}\n"
+                f"Leitung: {a['details'].leitung}\n"
+                f"Preis: {a['details'].preis}\n"
+                f"{TRENNLINIE}\n"
             )
-        nachricht += "\n"
+        teile.append("\n")
 
     if geloescht:
-        nachricht += "❌ Entfernte Kurse:\n\n"
+        teile.append("❌ Entfernte Kurse:\n\n")
         for a in geloescht:
-            nachricht += (
+            teile.append(
                 f"Kursnummer: {a['kurs_nr']}\n"
                 f"Letzter bekannter Status: {a['alter_status']}\n"
-                f"Tag: {a['details']['tag']}\n"
-                f"Zeit: {a['details']['zeit']}\n"
-                f"Zeitraum: {a['details']['zeitraum']}\n"
-                f"Leitung: {a['details']['leitung']}\n"
-                f"Preis: {a['details']['preis']}\n"
-                f"{'-'*40}\n"
+                f"Tag: {a['details'].tag}\n"
+                f"Zeit: {a['details'].zeit}\n"
+                f"Zeitraum: {a['details'].zeitraum}\n"
+                f"Leitung: {a['details'].leitung}\n"
+                f"Preis: {a['details'].preis}\n"
+                f"{TRENNLINIE}\n"
             )
-        nachricht += "\n"
+        teile.append("\n")
 
+    nachricht = "".join(teile)
     if not nachricht.strip():
         return
 
@@ -265,29 +444,38 @@ def sende_email(aenderungen):
 
     # Senden
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+        verschicke(msg)
         logging.info("E-Mail erfolgreich gesendet.")
     except Exception as e:
         logging.exception(f"Fehler beim Senden der E-Mail: {e}")
 
+_ERROR_LOG = None  # Zeitpunkt der letzten Fehlermail pro Betreff, einmalig von Platte geladen
+
+
+def lade_fehlerlog():
+    """
+    Gibt das Fehlerlog zurück. Die Datei wird nur beim ersten Aufruf gelesen,
+    danach wird das Dictionary im Speicher weiterverwendet.
+    """
+    global _ERROR_LOG
+    if _ERROR_LOG is None:
+        _ERROR_LOG = {}
+        if os.path.exists(ERROR_LOG_FILE):
+            try:
+                with open(ERROR_LOG_FILE, 'rb') as f:
+                    raw = json_loads(f.read())
+                    _ERROR_LOG = {k: datetime.fromisoformat(v) for k, v in raw.items()}
+            except Exception as e:
+                logging.warning(f"Fehler beim Laden der Fehlerlog-Datei: {e}")
+    return _ERROR_LOG
+
+
 def sende_error_email(betreff, fehlertext):
     """
     Sendet eine Fehlerbenachrichtigung per Mail – maximal einmal pro 24h pro Fehlertyp.
     """
     now = datetime.now()
-
-    # Vorherige Fehlermeldungen laden
-    error_log = {}
-    if os.path.exists(ERROR_LOG_FILE):
-        try:
-            with open(ERROR_LOG_FILE, 'r') as f:
-                raw = json.load(f)
-                error_log = {k: datetime.fromisoformat(v) for k, v in raw.items()}
-        except Exception as e:
-            logging.warning(f"Fehler beim Laden der Fehlerlog-Datei: {e}")
+    error_log = lade_fehlerlog()
 
     last_sent = error_log.get(betreff)
     if last_sent and (now - last_sent).total_seconds() < ERROR_INTERVAL_HOURS * 3600:
@@ -301,17 +489,13 @@ def sende_error_email(betreff, fehlertext):
     msg['To'] = EMAIL_TO
 
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.sendmail(EMAIL_FROM, [EMAIL_TO], msg.as_string())
+        verschicke(msg)
         logging.info(f"Fehlermeldung '{betreff}' gesendet.")
-        error_log[betreff] = now.isoformat()
+        error_log[betreff] = now
 
-        # Fehlerlog speichern
+        # Fehlerlog nur speichern, wenn tatsächlich eine Mail rausging
         try:
-            with open(ERROR_LOG_FILE, 'w') as f:
-                json.dump({k: v.isoformat() for k, v in error_log.items()}, f, indent=2)
+            schreibe_atomar(ERROR_LOG_FILE, json_dumps({k: v.isoformat() for k, v in error_log.items()}))
         except Exception as e:
             logging.warning(f"Fehler beim Speichern der Fehlerlog-Datei: {e}")
 
@@ -334,14 +518,15 @@ def main():
 
     while True:
         try:
-            kurse = scrape_kurse()
+            jetzt = time.time()  # einmal pro Durchlauf, als Unix-Zeitstempel gespeichert
+            zustand = lade_zustand()
+            kurse = scrape_kurse(zustand)
             if not kurse:
                 logging.info("Keine Kurse gefunden.")
                 sende_error_email("Keine Kurse gefunden", "Scraping erfolgreich, aber keine Kurse in der Tabelle.")
                 time.sleep(INTERVAL)
                 continue
 
-            zustand = lade_zustand()
             aenderungen = vergleiche_kurse(zustand.get('kurse', []), kurse)
 
             if aenderungen:
@@ -350,13 +535,20 @@ def main():
             else:
                 logging.info("Keine Änderungen erkannt.")
 
-            # Gelöschte Kurse aus Cache entfernen
-            entfernte_kurse = {a['kurs_nr'] for a in aenderungen if a['typ'] == 'geloescht'}
-            neuer_zustand = {
-                'kurse': [kurs for kurs in kurse if kurs['kurs_nr'] not in entfernte_kurse],
-                'letzte_pruefung': str(datetime.now())
-            }
-            speichere_zustand(neuer_zustand)
+            if not aenderungen and kurse == zustand.get('kurse'):
+                # Unveränderte Kursliste: nur den Prüfzeitpunkt aktualisieren
+                zustand['letzte_pruefung'] = jetzt
+                speichere_zustand(zustand)
+            else:
+                # Gelöschte Kurse aus Cache entfernen
+                entfernte_kurse = {a['kurs_nr'] for a in aenderungen if a['typ'] == 'geloescht'}
+                neuer_zustand = {
+                    'kurse': [kurs for kurs in kurse if kurs.kurs_nr not in entfernte_kurse],
+                    'letzte_pruefung': jetzt,
+                    'http_cache': zustand.get('http_cache', {}),
+                    'page_digest': zustand.get('page_digest')
+                }
+                speichere_zustand(neuer_zustand)
 
         except Exception as e:
             logging.exception("Fehler im Hauptprozess")
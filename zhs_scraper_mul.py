@@ -1,17 +1,31 @@
 import os
 import time
-import json
+import hashlib
 import logging
 from datetime import datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    json_dumps_compact = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:  # Fallback auf die Standardbibliothek
+    import json
+
+    def json_dumps_compact(obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    json_loads = json.loads
+
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -27,6 +41,7 @@ SMTP_USER       = os.getenv("SMTP_USER")
 SMTP_PASSWORD   = os.getenv("SMTP_PASSWORD")
 EMAIL_FROM      = os.getenv("EMAIL_FROM")
 EMAIL_TO        = os.getenv("EMAIL_TO", "").split(",")
+MAX_WORKERS     = 16  # parallele Seitenabrufe pro Durchlauf
 
 # --- Logger Setup ---------------------------------------------------------
 def setup_logger(debug=False):
@@ -40,16 +55,28 @@ def setup_logger(debug=False):
     logger.addHandler(ch)
 
 # --- HTTP Session mit Retry -----------------------------------------------
+# Brotli nur anbieten, wenn urllib3 es auch dekodieren kann
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
 def make_session():
     session = requests.Session()
     retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retries)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
     return session
 
 SESSION = make_session()
 
+# ETag/Last-Modified, Inhalts-Hash und zuletzt geparste Kurse pro (Kursname, URL);
+# der Name gehört zum Schlüssel, da dieselbe URL mit anderen Tabellen konfiguriert sein kann
+HTTP_CACHE = {}
+
 # --- Fehlerprotokollierung nur Konsole -----------------------------------
 ERROR_TIMEOUTS = {
     'Scraping-Fehler': timedelta(hours=1),
@@ -81,72 +108,185 @@ def send_email_raw(subject, body, html_body=None):
         logging.error(f"Fehler beim Senden der E-Mail: {e}")
 
 def send_error_email(subject, message):
-    body = f"Fehler im ZHS Kurs-Scraper:\n\n{message}\n\nZeit: {datetime.now().isoformat()}"
-    html = f"<h1>Fehler im ZHS Kurs-Scraper:</h1><p>{message}</p><p>Zeit: {datetime.now().isoformat()}</p>"
+    zeit = datetime.now().isoformat()
+    body = f"Fehler im ZHS Kurs-Scraper:\n\n{message}\n\nZeit: {zeit}"
+    html = f"<h1>Fehler im ZHS Kurs-Scraper:</h1><p>{message}</p><p>Zeit: {zeit}</p>"
     send_email_raw(subject, body, html)
 
 # --- Config, State --------------------------------------------------------
+# Geparste Konfiguration, wird nur bei geänderter mtime neu eingelesen
+_CFG_CACHE = {'mtime': 0, 'cfg': None}
+
 def load_config():
-    if not os.path.exists(CONFIG_FILE):
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except FileNotFoundError:
         logging.error(f"Konfigurationsdatei {CONFIG_FILE} nicht gefunden!")
         return None
-    with open(CONFIG_FILE, 'r') as f:
-        return json.load(f)
+    if mtime == _CFG_CACHE['mtime']:
+        return _CFG_CACHE['cfg']
+    try:
+        with open(CONFIG_FILE, 'rb') as f:
+            cfg = json_loads(f.read())
+    except ValueError as e:
+        # z.B. Datei wird gerade bearbeitet -> letzte gültige Konfiguration weiterverwenden
+        if _CFG_CACHE['cfg'] is None:
+            raise
+        logging.warning(f"Konfiguration ungültig, verwende letzte gültige Version: {e}")
+        return _CFG_CACHE['cfg']
+    _CFG_CACHE['mtime'] = mtime
+    _CFG_CACHE['cfg'] = cfg
+    logging.debug("Konfiguration neu geladen.")
+    return cfg
 
 def load_state():
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            return json.load(f)
+        with open(STATE_FILE, 'rb') as f:
+            return json_loads(f.read())
     return { 'kurse': [] }
 
+def write_atomic(path, data):
+    # Erst in Temp-Datei schreiben, dann atomar ersetzen -> nie halb geschriebene Dateien
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # z.B. Docker-Bind-Mount einer Einzeldatei: Umbenennen nicht möglich, direkt schreiben
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.remove(tmp_path)
+
+_last_state_hash = None  # Hash des zuletzt geschriebenen Zustands
+
 def save_state(state):
-    with open(STATE_FILE, 'w') as f:
-        json.dump(state, f, indent=2)
+    global _last_state_hash
+    data = json_dumps_compact(state)
+    h = hashlib.blake2b(data, digest_size=16).digest()
+    if h == _last_state_hash:
+        logging.debug("Zustand unverändert, nicht gespeichert.")
+        return
+    write_atomic(STATE_FILE, data)
+    _last_state_hash = h
 
 # --- Scraping -------------------------------------------------------------
-def scrape_tabelle(soup, idx, label=None):
-    tables = soup.select('table.bs_kurse')
-    if idx >= len(tables):
-        logging.warning(f"Tabelle Index {idx} nicht gefunden.")
-        return []
-    table = tables[idx]
-    headers = [th.get_text(strip=True) for th in table.select('thead th')]
+TABLE_SELECTOR = 'table.bs_kurse'
+# Buchungsstatus anhand des Buttons in der letzten Spalte: (Tag, Klasse) -> Status
+STATUS_MAP = {
+    ('span', 'bs_btn_abgelaufen'): 'abgelaufen',
+    ('input', 'bs_btn_warteliste'): 'Warteliste',
+    ('input', 'bs_btn_buchen'): 'buchen',
+    ('span', 'bs_btn_autostart'): 'buchbar_ab',
+}
+# Ein kombinierter Selektor -> eine Suche pro Zelle statt einer pro möglichem Button
+STATUS_SELECTOR = ', '.join(f"{tag}.{cls}" for tag, cls in STATUS_MAP)
+
+def button_status(cell):
+    el = cell.css_first(STATUS_SELECTOR)
+    if el is None:
+        return 'unbekannt'
+    for cls in (el.attributes.get('class') or '').split():
+        status = STATUS_MAP.get((el.tag, cls))
+        if status:
+            return status
+    return 'unbekannt'
+
+def child_elements(node, tag):
+    # nur direkte Kinder -> keine Zeilen/Zellen aus verschachtelten Tabellen, kein erneutes Durchsuchen
+    return [c for c in node.iter() if c.tag == tag] if node is not None else []
+
+def scrape_tabelle(table, tabname, kursname=None):
+    thead = None
+    rows = []
+    for section in table.iter():
+        if section.tag == 'thead' and thead is None:
+            thead = section
+        elif section.tag == 'tbody':
+            rows.extend(child_elements(section, 'tr'))  # Zeilen aus allen tbody-Abschnitten
+    head_rows = child_elements(thead, 'tr')
+
+    headers = [th.text(strip=True) for tr in head_rows for th in child_elements(tr, 'th')]
     if not headers:
-        first_row = table.select_one('tr')
-        headers = [td.get_text(strip=True) for td in first_row.find_all(['td', 'th'])]
+        if not (head_rows or rows):
+            return []
+        first_row = (head_rows or rows)[0]
+        headers = [td.text(strip=True) for td in first_row.iter() if td.tag in ('td', 'th')]
+
+    # Schlüsselspalte einmal pro Tabelle bestimmen, headers_key verwendet sie für alle Zeilen
+    resolve_key_column((kursname, tabname), headers)
 
     kurse = []
-    for row in table.select('tbody tr'):
-        cols = row.find_all('td')
+    for row in rows:
+        cols = child_elements(row, 'td')
         if len(cols) != len(headers):
             continue
-        info = { headers[i]: cols[i].get_text(strip=True) for i in range(len(headers)) }
-        info['status'] = 'unbekannt'
-        last_cell = cols[-1]
-        if last_cell.find('span', class_='bs_btn_abgelaufen'):
-            info['status'] = 'abgelaufen'
-        elif last_cell.find('input', class_='bs_btn_warteliste'):
-            info['status'] = 'Warteliste'
-        elif last_cell.find('input', class_='bs_btn_buchen'):
-            info['status'] = 'buchen'
-        elif last_cell.find('span', class_='bs_btn_autostart'):
-            info['status'] = 'buchbar_ab'
-        info['tabellenname'] = label or f"Tabelle_{idx}"
+        info = dict(zip(headers, (c.text(strip=True) for c in cols)))
+        info['status'] = button_status(cols[-1])
+        info['tabellenname'] = tabname
         kurse.append(info)
     return kurse
 
+def parse_kurs(content, cfg):
+    # Läuft im Worker-Thread des Abrufs
+    tree = LexborHTMLParser(content)
+    tables = tree.css(TABLE_SELECTOR)  # einmal pro Seite, nicht pro konfigurierter Tabelle
+    all_kurse = []
+    for tab in cfg.get('tabellen', []):
+        idx = tab['index']
+        if idx >= len(tables):
+            logging.warning(f"Tabelle Index {idx} nicht gefunden.")
+            continue
+        tabname = tab.get('bezeichnung') or f"Tabelle_{idx}"
+        kurse = scrape_tabelle(tables[idx], tabname, cfg['name'])
+        for k in kurse:
+            k['kursname'] = cfg['name']
+            k['url'] = cfg['url']
+        all_kurse.extend(kurse)
+    return all_kurse
+
 def scrape_kurs(cfg):
     try:
-        r = SESSION.get(cfg['url'], timeout=10)
+        cache_key = (cfg['name'], cfg['url'])
+        # Das gecachte Ergebnis gilt nur für die Tabellenauswahl, mit der es geparst wurde
+        spec = tuple((t['index'], t.get('bezeichnung')) for t in cfg.get('tabellen', []))
+        cached = HTTP_CACHE.get(cache_key, {})
+        if cached.get('spec') != spec:
+            cached = {}
+        headers = {}
+        # Validatoren nur mitschicken, wenn ein 304 auch aus dem Cache bedient werden kann
+        if 'kurse' in cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        r = SESSION.get(cfg['url'], headers=headers, timeout=10)
+        if r.status_code == 304:
+            logging.debug(f"{cfg['name']} unverändert (304), verwende Cache.")
+            return cached['kurse']
         r.raise_for_status()
-        soup = BeautifulSoup(r.content, 'html.parser')
-        all_kurse = []
-        for tab in cfg.get('tabellen', []):
-            kurse = scrape_tabelle(soup, tab['index'], tab.get('bezeichnung'))
-            for k in kurse:
-                k['kursname'] = cfg['name']
-                k['url'] = cfg['url']
-            all_kurse.extend(kurse)
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+
+        # Server ohne Validatoren: identischer Inhalt -> Parsen überspringen
+        digest = hashlib.blake2b(r.content, digest_size=16).digest()
+        if cached.get('digest') == digest:
+            logging.debug(f"{cfg['name']} Inhalt unverändert, verwende Cache.")
+            cached['etag'] = etag
+            cached['last_modified'] = last_modified
+            return cached['kurse']
+
+        all_kurse = parse_kurs(r.content, cfg)
+        HTTP_CACHE[cache_key] = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'digest': digest,
+            'spec': spec,
+            'kurse': all_kurse,
+        }
         return all_kurse
     except Exception as e:
         logging.exception(f"Fehler beim Scrapen von {cfg['name']}: {e}")
@@ -154,40 +294,79 @@ def scrape_kurs(cfg):
         return []
 
 # --- Vergleich ------------------------------------------------------------
+KEY_COLUMNS = ('Nr.', 'Kursnummer', 'kurs_nr', 'Nr', 'KursnrNo.')
+
+# (kursname, tabellenname) -> (Überschriften, Schlüsselspalte), über alle Durchläufe gemerkt;
+# Schlüsselspalte None = zusammengesetzter Schlüssel, Überschriften None = aus dem Zustand bestimmt
+_RESOLVED_KEY = {}
+
+def probe_key_column(columns):
+    return next((key for key in KEY_COLUMNS if key in columns), None)
+
+def resolve_key_column(grp, headers):
+    # Einmal pro Tabelle aus scrape_tabelle; neu bestimmt wird nur, wenn sich die Überschriften ändern.
+    headers = tuple(headers)
+    cached = _RESOLVED_KEY.get(grp)
+    if cached is not None and cached[0] == headers:
+        return cached[1]
+    key_col = probe_key_column(headers)
+    _RESOLVED_KEY[grp] = (headers, key_col)
+    return key_col
+
 def headers_key(k):
-    for key in ['Nr.', 'Kursnummer', 'kurs_nr', 'Nr', 'KursnrNo.']:
-        if key in k:
-            return k[key]
+    # Verwendet die von scrape_tabelle bestimmte Schlüsselspalte, ohne pro Kurs neu zu suchen
+    grp = (k['kursname'], k['tabellenname'])
+    cached = _RESOLVED_KEY.get(grp)
+    if cached is None:
+        # gespeicherter Zustand vor dem ersten Abruf
+        key_col = probe_key_column(k)
+        _RESOLVED_KEY[grp] = (None, key_col)
+    else:
+        key_col = cached[1]
+        if key_col is not None and key_col not in k:
+            key_col = probe_key_column(k)  # Kurs mit älteren Überschriften
+    if key_col is not None:
+        return k[key_col]
     return f"{k.get('Tag','')}_{k.get('Zeit','')}_{k.get('Leitung','')}"
 
-def compare_kurse(old, new, interesting):
-    changes = []
-    old_map = { (k['kursname'], k['tabellenname'], headers_key(k)): k for k in old }
-    new_map = { (k['kursname'], k['tabellenname'], headers_key(k)): k for k in new }
+def build_kurs_map(kurse):
+    return { (k['kursname'], k['tabellenname'], headers_key(k)): k for k in kurse }
 
-    for key, nk in new_map.items():
-        if key not in old_map and nk['status'] in interesting:
-            changes.append({'typ': 'neu', 'kurs': nk})
-        elif key in old_map:
-            ok = old_map[key]
-            if ok['status'] != nk['status'] and nk['status'] in interesting:
-                changes.append({'typ': 'status_update', 'alt': ok, 'neu': nk})
+def compare_kurse(old_map, new, interesting):
+    # old_map: Ergebnis von build_kurs_map für den gespeicherten Zustand (wird in main gecacht)
+    changes = []
+    # Rückwärts, damit bei doppelten Schlüsseln wie in build_kurs_map die letzte Zeile gewinnt
+    seen = set()
+    for nk in reversed(new):
+        key = (nk['kursname'], nk['tabellenname'], headers_key(nk))
+        if key in seen:
+            continue
+        seen.add(key)
+        ok = old_map.get(key)
+        if ok is None:
+            if nk['status'] in interesting:
+                changes.append({'typ': 'neu', 'kurs': nk})
+        elif ok['status'] != nk['status'] and nk['status'] in interesting:
+            changes.append({'typ': 'status_update', 'alt': ok, 'neu': nk})
+    changes.reverse()
 
     for key, ok in old_map.items():
-        if key not in new_map:
+        if key not in seen:
             changes.append({'typ': 'geloescht', 'kurs': ok})
 
     return changes
 
 # --- E-Mail Formatting ----------------------------------------------------
+PRIO = ('KursnrNo.', 'TagDay', 'ZeitTime', 'OrtLocation', 'LeitungGuidance', 'PreisCost')
+SKIP = frozenset(PRIO + ('kursname', 'tabellenname', 'url', 'status'))
+
 def format_kurs_info(k):
-    prio = ['KursnrNo.', 'TagDay', 'ZeitTime', 'OrtLocation', 'LeitungGuidance', 'PreisCost']
     lines = [f"<b>{k['kursname']}</b> ({k['tabellenname']})<br>Status: {k['status']}<br><a href='{k['url']}'>{k['url']}</a><br>"]
-    for p in prio:
+    for p in PRIO:
         if p in k:
             lines.append(f"{p}: {k[p]}<br>")
     for kk, vv in k.items():
-        if kk not in prio + ['kursname', 'tabellenname', 'url', 'status']:
+        if kk not in SKIP:
             lines.append(f"{kk}: {vv}<br>")
     return ''.join(lines)
 
@@ -200,28 +379,33 @@ def send_changes_email(changes):
         structured[k['kursname']][k['tabellenname']].append(c)
 
     subject = "ZHS Kurs-Update: Gesamtübersicht"
-    body = ""
-    html = ""
+    body_parts = []
+    html_parts = []
     for kursname, tabellen in structured.items():
-        html += f"<h1>{kursname}</h1>"
-        body += f"{kursname}\n\n"
+        html_parts.append(f"<h1>{kursname}</h1>")
+        body_parts.append(f"{kursname}\n\n")
         for tabname, items in tabellen.items():
-            html += f"<h2>{tabname}</h2>"
-            body += f"{tabname}\n"
+            html_parts.append(f"<h2>{tabname}</h2>")
+            body_parts.append(f"{tabname}\n")
             for c in items:
+                # einmal formatieren, für HTML und Text wiederverwenden
+                info_html = format_kurs_info(c['neu'] if c['typ'] == 'status_update' else c['kurs'])
+                info_text = info_html.replace('<br>', '\n')
                 if c['typ'] == 'neu':
-                    html += "<h3>🟢 Neuer Kurs</h3>" + format_kurs_info(c['kurs']) + "<br><br>"
-                    body += format_kurs_info(c['kurs']).replace('<br>', '\n') + "\n\n"
+                    html_parts.append("<h3>🟢 Neuer Kurs</h3>" + info_html + "<br><br>")
+                    body_parts.append(info_text + "\n\n")
                 elif c['typ'] == 'status_update':
                     nk = c['neu']
                     ok = c['alt']
-                    html += f"<h3>🔁 Statusänderung</h3>" + format_kurs_info(nk) + f"Status: {ok['status']} → {nk['status']}<br><br>"
-                    body += format_kurs_info(nk).replace('<br>', '\n') + f"\nStatus: {ok['status']} → {nk['status']}\n\n"
+                    html_parts.append(f"<h3>🔁 Statusänderung</h3>" + info_html + f"Status: {ok['status']} → {nk['status']}<br><br>")
+                    body_parts.append(info_text + f"\nStatus: {ok['status']} → {nk['status']}\n\n")
                 elif c['typ'] == 'geloescht':
-                    html += "<h3>❌ Gelöscht</h3>" + format_kurs_info(c['kurs']) + "<br><br>"
-                    body += format_kurs_info(c['kurs']).replace('<br>', '\n') + "\n\n"
-            body += "\n"
+                    html_parts.append("<h3>❌ Gelöscht</h3>" + info_html + "<br><br>")
+                    body_parts.append(info_text + "\n\n")
+            body_parts.append("\n")
 
+    body = ''.join(body_parts)
+    html = ''.join(html_parts)
     send_email_raw(subject, body, html)
 
 # --- Main Loop ------------------------------------------------------------
@@ -231,10 +415,17 @@ def main():
     args = parser.parse_args()
     setup_logger(debug=args.debug)
 
+    pending_changes = []
+    last_sent = None
+    # Ein Pool für die gesamte Laufzeit; Threads werden bei Bedarf angelegt und wiederverwendet
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
     try:
         state = load_state()
+        # Schlüssel->Kurs des Zustands, nur nach einem neuen Zustand neu aufbauen
+        old_map = build_kurs_map(state.get('kurse', []))
         interval = None
         interesting = None
+        debounce = 0
 
         while True:
             config = load_config()
@@ -244,23 +435,36 @@ def main():
 
             interval = config.get("interval", interval or 600)
             interesting = config.get("interesting_status", interesting or ["buchen", "Warteliste", "buchbar_ab"])
+            debounce = config.get("notify_debounce", debounce)
 
+            # Seiten parallel abrufen, Ergebnisse in Konfigurationsreihenfolge übernehmen
+            kurs_cfgs = config.get('kurse', [])
             all_new = []
-            for cfg in config.get('kurse', []):
+            futures = [(cfg, executor.submit(scrape_kurs, cfg)) for cfg in kurs_cfgs]
+            for cfg, future in futures:
                 try:
-                    all_new.extend(scrape_kurs(cfg))
+                    all_new.extend(future.result())
                 except Exception as e:
                     logging.error(f"Kurs {cfg['name']} ausgelassen: {e}")
 
-            changes = compare_kurse(state.get('kurse', []), all_new, interesting)
+            changes = compare_kurse(old_map, all_new, interesting)
 
             if changes:
-                send_changes_email(changes)
+                pending_changes.extend(changes)
                 save_state({'kurse': all_new})
-                state = {'kurse': all_new}
+                old_map = build_kurs_map(all_new)
             else:
                 logging.info("Keine Änderungen gefunden.")
 
+            # Änderungen sammeln und höchstens alle `debounce` Sekunden eine Mail schicken
+            now = time.monotonic()
+            if pending_changes and (last_sent is None or now - last_sent >= debounce):
+                send_changes_email(pending_changes)
+                pending_changes = []
+                last_sent = now
+            elif pending_changes:
+                logging.info(f"{len(pending_changes)} Änderung(en) vorgemerkt, Mail folgt nach Ablauf der Sperrzeit.")
+
             logging.info(f"Warte {interval} Sekunden...")
             time.sleep(interval)
 
@@ -269,6 +473,11 @@ def main():
     except Exception as e:
         logging.exception(f"Ungefangener Fehler im Haupt: {e}")
         handle_error("Ungefangener Fehler im Hauptloop", str(e))
+    finally:
+        # bereits gespeicherte, aber noch nicht verschickte Änderungen nicht verlieren
+        if pending_changes:
+            send_changes_email(pending_changes)
+        executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     main()